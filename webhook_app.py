@@ -1,113 +1,443 @@
 # -*- coding: utf-8 -*-
 from flask import Flask, request, abort
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 
 import gspread
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.oauth2.service_account import Credentials
-from datetime import datetime
+from google.auth.transport.requests import Request as GoogleAuthRequest
 import os
-import json
+import re
+try:
+    # orjson 解析比標準庫快數倍，沒安裝時退回 json
+    import orjson as _json
+except ImportError:
+    import json as _json
 import time
-import traceback
+import queue
+import atexit
+import threading
+import logging
+import logging.handlers
+import functools
+import unicodedata
+import operator
+from collections import OrderedDict
 import openai
 
 app = Flask(__name__)
 
+# === ✅ 日誌 ===
+# 用 logging 取代 print：%s 延遲格式化，等級關閉時不會組字串；大量訊息用 DEBUG
+# QueueHandler 在呼叫端就把紀錄格式化成完整一行，QueueListener 的背景執行緒只負責寫出
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s %(message)s"))
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), handlers=[_log_queue_handler])
+logger = logging.getLogger("webhook")
+
 # === ✅ 環境變數 ===
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN", "")
 LINE_CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET", "")
 SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID", "")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
+PROMPT_TEMPLATE_PATH = os.environ.get("PROMPT_TEMPLATE_PATH", "")
+
+# === ✅ HTTP 連線池 ===
+# LINE 與 Sheets 各用一個長駐 Session；連線失敗自動重試（非冪等請求不會重送已送出的內容）
+def pooled_adapter(pool_maxsize=20):
+    return HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=2, backoff_factor=0.2)
+    )
+
+# === ✅ LINE API 連線重用 ===
+# SDK 預設每次呼叫都用 requests.post 建新連線，改用共用 Session 保持 keep-alive。
+# LineBotApi 會自己用 timeout 建立 http_client 實例，所以 Session 放在類別屬性
+line_session = requests.Session()
+line_session.mount("https://", pooled_adapter())
+
+class SessionHttpClient(RequestsHttpClient):
+    session = line_session
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream,
+                                    timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data,
+                                     timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data,
+                                       timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data,
+                                    timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, timeout=5, http_client=SessionHttpClient)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
-openai.api_key = OPENAI_API_KEY
+# 共用一個 OpenAI client，重用其 httpx 連線池；
+# 逾時與重試（429/5xx 指數退避）交給 SDK，最壞延遲有上限
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 3))
+openai_client = openai.OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=2)
 
 # === ✅ Google Sheets 授權 ===
 scopes = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
-if "GOOGLE_CREDS_JSON" in os.environ:
-    creds_escaped = os.environ["GOOGLE_CREDS_JSON"]
-    creds_json_str = json.loads(creds_escaped)
-    creds_dict = json.loads(creds_json_str)
-    with open("google-credentials.json", "w", encoding="utf-8") as f:
-        json.dump(creds_dict, f)
-    credentials = Credentials.from_service_account_file("google-credentials.json", scopes=scopes)
-else:
-    credentials = Credentials.from_service_account_file("google-credentials.json", scopes=scopes)
-
-client = gspread.authorize(credentials)
-sheet = client.open_by_key(SPREADSHEET_ID).sheet1
-
-# === ✅ 寫入表單 ===
+
+def load_google_credentials():
+    if "GOOGLE_CREDS_JSON" in os.environ:
+        # 環境變數可能是 JSON 物件，也可能是被跳脫過一次的 JSON 字串，兩種都接受
+        creds_dict = _json.loads(os.environ["GOOGLE_CREDS_JSON"])
+        if isinstance(creds_dict, str):
+            creds_dict = _json.loads(creds_dict)
+        # 直接從記憶體載入，不把金鑰寫到磁碟
+        return Credentials.from_service_account_info(creds_dict, scopes=scopes)
+    return Credentials.from_service_account_file("google-credentials.json", scopes=scopes)
+
+# 第一次用到時才授權、開啟工作表，import 不做任何 Google 相關初始化；
+# 憑證有問題也不會讓整個程序啟動失敗。鎖確保多執行緒同時第一次呼叫只初始化一次
+_google_lock = threading.RLock()
+# gspread 預設沒有逾時，卡住的連線會讓持有鎖的執行緒一直等下去
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", 10))
+_gspread_client = None
+_sheets = {}
+
+def get_gspread_client():
+    global _gspread_client
+    if _gspread_client is None:
+        with _google_lock:
+            if _gspread_client is None:
+                client = gspread.authorize(load_google_credentials())
+                client.set_timeout(SHEETS_TIMEOUT)
+                # gspread 共用同一個 AuthorizedSession，加大連線池讓背景執行緒重用 keep-alive 連線
+                getattr(client, "http_client", client).session.mount("https://", pooled_adapter())
+                _gspread_client = client
+    return _gspread_client
+
+def get_google_session():
+    client = get_gspread_client()
+    return getattr(client, "http_client", client).session
+
+def get_sheet(sheet_id=SPREADSHEET_ID):
+    sheet = _sheets.get(sheet_id)
+    if sheet is None:
+        with _google_lock:
+            sheet = _sheets.get(sheet_id)
+            if sheet is None:
+                sheet = _sheets[sheet_id] = get_gspread_client().open_by_key(sheet_id).sheet1
+    return sheet
+
+def reset_google_client():
+    global _gspread_client
+    with _google_lock:
+        _gspread_client = None
+        _sheets.clear()
+
+# Sheets 呼叫遇到 401（授權失效）或暫時性 5xx 時重試；401 會丟掉快取的 client 重新授權。
+# 5xx 重試只適用於可重複送出的請求
+SHEETS_RETRY_STATUSES = (401, 500, 502, 503)
+
+def sheets_retry(tries=3, delay=0.3, backoff=2, statuses=SHEETS_RETRY_STATUSES):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            wait = delay
+            for attempt in range(1, tries + 1):
+                try:
+                    return fn(*args, **kwargs)
+                except (gspread.exceptions.APIError, requests.HTTPError) as e:
+                    status = getattr(e.response, "status_code", None)
+                    if attempt == tries or status not in statuses:
+                        raise
+                    logger.warning("⚠️ Sheets 錯誤 %s，重試第 %d 次", status, attempt)
+                    if status == 401:
+                        reset_google_client()
+                    time.sleep(wait)
+                    wait *= backoff
+        return wrapper
+    return decorator
+
+# === ✅ Google token 預先更新 ===
+# access token 約 1 小時過期，過期後第一個 Sheets 呼叫會同步 refresh；
+# 背景每 50 分鐘先更新，使用者的請求不必等 token 交換
+TOKEN_REFRESH_INTERVAL = 50 * 60
+
+def refresh_google_token():
+    try:
+        session = get_google_session()
+        # token 交換不持有 _google_lock，避免卡住 get_sheet 與重新授權；
+        # google-auth 預設逾時 120 秒，改用與 Sheets 相同的逾時
+        session.credentials.refresh(functools.partial(GoogleAuthRequest(), timeout=SHEETS_TIMEOUT))
+        logger.info("🔑 Google token 已更新")
+    except Exception as e:
+        logger.warning("⚠️ 更新 Google token 錯誤：%s", e)
+
+def _token_refresh_loop():
+    while True:
+        time.sleep(TOKEN_REFRESH_INTERVAL)
+        refresh_google_token()
+
+threading.Thread(target=_token_refresh_loop, name="google-token-refresh", daemon=True).start()
+
+# === ✅ 寫入表單（批次寫入）===
+# 每則訊息只把 row 放進佇列，由背景執行緒定期以一次 append 批次寫入，
+# 避免每則訊息都打一次 Sheets API（延遲高且容易撞到寫入配額）
+FLUSH_INTERVAL = float(os.environ.get("SHEET_FLUSH_INTERVAL", 2))
+FLUSH_MAX_ROWS = int(os.environ.get("SHEET_FLUSH_MAX_ROWS", 500))
+# 累積到這麼多筆就不等計時，立刻喚醒背景執行緒寫入
+FLUSH_TRIGGER_ROWS = int(os.environ.get("SHEET_FLUSH_TRIGGER_ROWS", 50))
+
+_pending = queue.Queue()
+_flush_lock = threading.Lock()
+_flush_wakeup = threading.Event()
+# 寫入失敗的批次留在這裡，下一輪最先寫入以維持時間順序；只在 _flush_lock 內存取
+_retry_rows = []
+
+# 直接呼叫 Sheets REST values:append，不經過 gspread 的 Worksheet 包裝；
+# 範圍不指定工作表名稱即為第一個工作表（同 sheet1）
+SHEETS_APPEND_URL = f"https://sheets.googleapis.com/v4/spreadsheets/{SPREADSHEET_ID}/values/A1:append"
+
+# append 不是冪等操作：5xx 時 Sheets 可能已寫入，重送會重複整批資料，所以只在 401 重試；
+# 其他失敗交給 flush_pending_rows 的 _retry_rows 下一輪再寫，仍可能重複（至少寫入一次）
+@sheets_retry(statuses=(401,))
+def append_rows_to_sheet(rows):
+    response = get_google_session().post(
+        SHEETS_APPEND_URL,
+        params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+        json={"values": rows},
+        timeout=SHEETS_TIMEOUT
+    )
+    response.raise_for_status()
+
+# 欄位順序固定，預先建好 itemgetter，一次取出所有欄位
+_ROW_DEFAULTS = {"分類": "", "品項": "", "單價": "", "數量": "", "備註": ""}
+_get_row_fields = operator.itemgetter("分類", "品項", "單價", "數量", "備註")
+
+# 時間只記到分鐘，同一分鐘內的紀錄共用格式化好的字串
+@functools.lru_cache(maxsize=4)
+def _format_minute(minute):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(minute * 60))
+
 def write_record_to_sheet(record):
-    now = datetime.now().strftime("%Y-%m-%d %H:%M")
-    total = record["單價"] * record["數量"]
-    row = [
-        now,
-        record.get("分類", ""),
-        record.get("品項", ""),
-        record.get("單價", ""),
-        record.get("數量", ""),
-        total,
-        record.get("備註", "")
-    ]
-    sheet.append_row(row)
-    print("✅ 寫入成功：", row)
+    now = _format_minute(int(time.time() // 60))
+    category, item, price, quantity, note = _get_row_fields({**_ROW_DEFAULTS, **record})
+    row = [now, category, item, price, quantity, price * quantity, note]
+    _pending.put(row)
+    if _pending.qsize() >= FLUSH_TRIGGER_ROWS:
+        _flush_wakeup.set()
+    logger.debug("📝 已排入寫入佇列：%s", row)
+
+# 401/429 以外的 4xx（如 SPREADSHEET_ID 錯誤、沒有權限）是請求本身有問題，重試也不會成功
+def is_permanent_sheets_error(e):
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in (401, 429)
+
+def flush_pending_rows():
+    with _flush_lock:
+        while True:
+            rows = _retry_rows[:FLUSH_MAX_ROWS]
+            del _retry_rows[:len(rows)]
+            while len(rows) < FLUSH_MAX_ROWS:
+                try:
+                    rows.append(_pending.get_nowait())
+                except queue.Empty:
+                    break
+            if not rows:
+                return
+            try:
+                append_rows_to_sheet(rows)
+                logger.info("✅ 批次寫入成功：%d 筆", len(rows))
+            except Exception as e:
+                if is_permanent_sheets_error(e):
+                    # 不再重試，把整批資料寫進日誌，避免無限重試讓佇列越積越多
+                    logger.critical("🚨 批次寫入失敗且無法重試，捨棄 %d 筆：%s；資料：%s", len(rows), e, rows)
+                    continue
+                logger.error("❌ 批次寫入錯誤：%s", e)
+                # 放回重試區最前面，下一輪先寫，避免資料遺失也不打亂順序
+                _retry_rows[:0] = rows
+                return
+
+def _flush_loop():
+    while True:
+        _flush_wakeup.wait(FLUSH_INTERVAL)
+        _flush_wakeup.clear()
+        flush_pending_rows()
+
+threading.Thread(target=_flush_loop, name="sheet-flush", daemon=True).start()
 
 # === ✅ GPT 分析訊息（強制 JSON）===
-def analyze_message_with_gpt(text, retry=2):
-    prompt = f"""
-你是一個 LINE 記帳小幫手，請將以下訊息轉為【純 JSON】格式，格式如下（不要多加說明文字）：
-
-{{
-  "分類": "食",
-  "品項": "蘋果",
-  "單價": 12,
-  "數量": 1,
-  "備註": "LINE輸入"
-}}
-
-⚠️ 請注意：
-- 僅回傳一個 JSON 區塊，不需要說明文字
-- 所有欄位都要有，若沒有請填 ""
-- 數字欄位必須是數字（如：單價、數量）
-- 不要換行、不要加上「以下是」或「這是你要的」之類的語句
-
-使用者輸入：
-{text}
-    """
+# 固定指示放在 system message，每次呼叫內容完全相同，user message 只帶使用者輸入
+SYSTEM_PROMPT = """你是 LINE 記帳小幫手，把使用者訊息轉成 JSON 物件，只回傳 JSON：
+{"分類": "食", "品項": "蘋果", "單價": 12, "數量": 1, "備註": "LINE輸入"}
+- 所有欄位都要有，沒有就填 ""
+- 單價、數量必須是數字"""
+# 可用 PROMPT_TEMPLATE_PATH 指定檔案覆寫指示內容（啟動時讀一次）
+if PROMPT_TEMPLATE_PATH:
+    with open(PROMPT_TEMPLATE_PATH, encoding="utf-8") as f:
+        SYSTEM_PROMPT = f.read()
+    # JSON mode 要求訊息裡出現「JSON」，否則每次呼叫都是 400；啟動時就擋下
+    if "json" not in SYSTEM_PROMPT.lower():
+        raise ValueError(f"PROMPT_TEMPLATE_PATH 指定的提示詞必須包含「JSON」：{PROMPT_TEMPLATE_PATH}")
+
+# === ✅ GPT 結果快取 ===
+# 同樣的輸入（如「咖啡 60」）重複出現時直接用上次的分析結果，不再呼叫 GPT
+GPT_CACHE_SIZE = int(os.environ.get("GPT_CACHE_SIZE", 1024))
+GPT_CACHE_TTL = 30 * 86400
+_WHITESPACE_RE = re.compile(r"\s+")
+_gpt_cache = OrderedDict()
+_gpt_cache_lock = threading.Lock()
+
+def _normalize_text(text):
+    # NFKC 讓全形數字、全形空白等與半形視為相同輸入（「咖啡　６０」＝「咖啡 60」）
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text).strip().lower())
+
+def _get_cached_record(key):
+    with _gpt_cache_lock:
+        item = _gpt_cache.get(key)
+        if item is None:
+            return None
+        ts, record = item
+        if time.time() - ts > GPT_CACHE_TTL:
+            del _gpt_cache[key]
+            return None
+        _gpt_cache.move_to_end(key)
+        return dict(record)
+
+def _put_cached_record(key, record):
+    with _gpt_cache_lock:
+        _gpt_cache[key] = (time.time(), dict(record))
+        _gpt_cache.move_to_end(key)
+        while len(_gpt_cache) > GPT_CACHE_SIZE:
+            _gpt_cache.popitem(last=False)
+
+# 通過欄位檢查後才存入快取，不完整的結果下次仍重新分析；已在快取中的不更新時間
+def cache_gpt_record(text, record):
+    key = _normalize_text(text)
+    with _gpt_cache_lock:
+        if key in _gpt_cache:
+            return
+    _put_cached_record(key, record)
+
+def analyze_message_with_gpt(text):
+    cache_key = _normalize_text(text)
+    cached = _get_cached_record(cache_key)
+    if cached is not None:
+        logger.debug("⚡ 使用快取結果：%s", cached)
+        return cached
+
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2
+        response = openai_client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": text}
+            ],
+            temperature=0.2,
+            max_tokens=120,
+            response_format={"type": "json_object"}
         )
-        content = response.choices[0].message.content.strip()
-        print("📤 GPT 原始回應：", content)
+    except openai.BadRequestError:
+        # 請求本身有問題，重試也不會成功
+        raise
+    except openai.APIError as e:
+        logger.error("❌ GPT 呼叫失敗：%s", e)
+        return None
+
+    content = response.choices[0].message.content.strip()
+    logger.debug("📤 GPT 原始回應：%s", content)
+
+    # JSON mode 保證回傳合法 JSON，不需再擷取 {} 區塊或替換引號
+    try:
+        record = _json.loads(content)
+    except ValueError as e:
+        logger.error("❌ GPT 分析錯誤：%s", e)
+        logger.warning("⚠️ GPT 回傳內容：%s", content)
+        return None
+    return record
+
+# === ✅ 快速解析（「品項 金額」免 GPT）===
+# 「蘋果 12」「咖啡 60元」這類訊息直接解析；分類沿用先前 GPT 對同品項的判斷，
+# 或表單中已有的紀錄；沒看過的品項仍交給 GPT
+_item_categories = {}
 
-        start = content.find("{")
-        end = content.rfind("}")
-        if start == -1 or end == -1:
-            raise ValueError("找不到 JSON 區塊")
+# 只抓「分類、品項」兩欄（B:C），不下載整張表，60 秒內重複使用
+ITEM_INDEX_TTL = 60
+_item_index_ts = 0.0
+_item_index_lock = threading.Lock()
 
-        json_str = content[start:end+1]
-        json_str = json_str.replace("“", "\"").replace("”", "\"").replace("‘", "\"").replace("’", "\"")
-        json_str = json_str.replace("\n", "").replace("\\", "")
-        return json.loads(json_str)
+# 不加重試：讀取失敗就沿用現有分類表，TTL 到了再讀，不讓訊息處理等退避
+def fetch_item_category_rows():
+    # UNFORMATTED_VALUE 省去伺服器端格式化，回應較小
+    return get_sheet().get("B2:C", value_render_option="UNFORMATTED_VALUE")
 
+def refresh_item_categories():
+    global _item_index_ts
+    # 鎖只用來蓋時間戳記，確保同時只有一個執行緒去讀表單；
+    # 讀取在鎖外進行，其他執行緒直接用現有的分類表，不必排隊等網路
+    with _item_index_lock:
+        if time.time() - _item_index_ts < ITEM_INDEX_TTL:
+            return
+        _item_index_ts = time.time()
+    try:
+        rows = fetch_item_category_rows()
     except Exception as e:
-        print("❌ GPT 分析錯誤：", e)
-        print("⚠️ GPT 回傳內容：", locals().get("content", "（無內容）"))
-        if retry > 0:
-            print("🔁 正在重試...")
-            time.sleep(1.5)
-            return analyze_message_with_gpt(text, retry=retry-1)
+        logger.warning("⚠️ 讀取品項分類錯誤：%s", e)
+        return
+    for row in rows:
+        if len(row) >= 2 and row[0] and row[1]:
+            _item_categories.setdefault(str(row[1]), str(row[0]))
+
+# 只接受「品項 金額」或「品項 金額元」兩段式訊息；用 split 取代正規表示式，
+# 大多數不符合的長句在切段數就被排除
+def split_item_price(text):
+    parts = text.split()
+    # 單獨的「元」只在金額本身沒帶「元」時才算單位（「60元 元」不接受）
+    if len(parts) == 3 and parts[2] == "元" and not parts[1].endswith("元"):
+        parts.pop()
+    if len(parts) != 2:
         return None
+    item, price = parts
+    if price.endswith("元"):
+        price = price[:-1]
+    if not price.isdecimal():
+        return None
+    return item, int(price)
+
+def parse_message_fast(text):
+    parsed = split_item_price(text)
+    if not parsed:
+        return None
+    item, price = parsed
+    refresh_item_categories()
+    category = _item_categories.get(item)
+    if not category:
+        return None
+    return {
+        "分類": category,
+        "品項": item,
+        "單價": price,
+        "數量": 1,
+        "備註": ""
+    }
 
 # === ✅ webhook 接收 ===
 @app.route("/callback", methods=['POST'])
@@ -120,40 +450,135 @@ def callback():
         abort(400)
     return 'OK'
 
+# === ✅ 背景 worker ===
+# LINE webhook 超過約 1 秒未回應就會重送，GPT 與 Sheets 都很慢，改在背景執行緒處理
+# 佇列有上限：積壓太多時直接告知使用者忙碌中，而不是無限堆積
+MESSAGE_WORKERS = int(os.environ.get("MESSAGE_WORKERS", 8))
+MESSAGE_QUEUE_SIZE = int(os.environ.get("MESSAGE_QUEUE_SIZE", 100))
+# 排隊超過這個數量時先回覆「忙碌中」，結果稍後改用推播送出
+MESSAGE_QUEUE_BUSY_THRESHOLD = int(os.environ.get("MESSAGE_QUEUE_BUSY_THRESHOLD", 5))
+# 關閉時最多等 worker 處理完剩餘訊息的秒數
+MESSAGE_SHUTDOWN_TIMEOUT = float(os.environ.get("MESSAGE_SHUTDOWN_TIMEOUT", 10))
+work_queue = queue.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+_message_workers = []
+# 關閉開始後不再收新工作；與放入佇列共用同一把鎖，哨兵之後不會再有訊息進來
+_work_lock = threading.Lock()
+_accepting_work = True
+
+def enqueue_message(reply_token, to, text):
+    with _work_lock:
+        if not _accepting_work:
+            raise queue.Full
+        work_queue.put_nowait((reply_token, to, text))
+
+def _message_worker():
+    while True:
+        job = work_queue.get()
+        try:
+            if job is None:
+                return
+            process_message(*job)
+        except Exception as e:
+            # 任何例外都不能讓 worker 結束，否則執行緒池會默默變小
+            logger.exception("❌ worker 處理訊息錯誤：%s", e)
+        finally:
+            work_queue.task_done()
+
+for i in range(MESSAGE_WORKERS):
+    worker = threading.Thread(target=_message_worker, name=f"message-worker-{i}", daemon=True)
+    worker.start()
+    _message_workers.append(worker)
+
+# 程序結束時：停止收件 → 每個 worker 一個哨兵（排在剩餘訊息後面）→ 等 worker 結束 → 最後寫入表單
+def shutdown_message_workers():
+    global _accepting_work
+    with _work_lock:
+        _accepting_work = False
+    deadline = time.monotonic() + MESSAGE_SHUTDOWN_TIMEOUT
+    try:
+        for _ in _message_workers:
+            work_queue.put(None, timeout=max(0, deadline - time.monotonic()))
+    except queue.Full:
+        logger.warning("⚠️ 工作佇列仍滿，無法通知所有 worker 結束")
+    for worker in _message_workers:
+        worker.join(max(0, deadline - time.monotonic()))
+    alive = sum(worker.is_alive() for worker in _message_workers)
+    if alive:
+        logger.warning("⚠️ 仍有 %d 個 worker 未結束，佇列中剩餘的訊息不會處理", alive)
+    flush_pending_rows()
+
+# atexit 後註冊先執行：在日誌 listener 停止前完成
+atexit.register(shutdown_message_workers)
+
 # === ✅ 智慧傳訊工具 ===
-def smart_push_message(event, text):
+# 群組、聊天室的訊息推播回群組（與 reply 落在同一處），一對一才推給使用者
+def get_push_target(event):
+    for attr in ("group_id", "room_id", "user_id"):
+        target = getattr(event.source, attr, None)
+        if target:
+            return target
+    return None
+
+def smart_push_message(to, text):
+    if not to:
+        logger.warning("⚠️ 無法識別訊息來源")
+        return
     try:
-        if hasattr(event.source, 'user_id') and event.source.user_id:
-            line_bot_api.push_message(event.source.user_id, TextSendMessage(text=text))
-        elif hasattr(event.source, 'group_id') and event.source.group_id:
-            line_bot_api.push_message(event.source.group_id, TextSendMessage(text=text))
-        elif hasattr(event.source, 'room_id') and event.source.room_id:
-            line_bot_api.push_message(event.source.room_id, TextSendMessage(text=text))
-        else:
-            print("⚠️ 無法識別訊息來源")
+        line_bot_api.push_message(to, TextSendMessage(text=text))
     except Exception as e:
-        print("⚠️ 傳送訊息錯誤：", e)
+        logger.warning("⚠️ 傳送訊息錯誤：%s", e)
+
+# 優先用 reply token 回覆（一次呼叫、不佔推播額度）；token 失效或已用過才改用 push
+def smart_reply_message(reply_token, to, text):
+    if not reply_token:
+        smart_push_message(to, text)
+        return
+    try:
+        line_bot_api.reply_message(reply_token, TextSendMessage(text=text))
+    except (LineBotApiError, requests.RequestException) as e:
+        logger.warning("⚠️ 回覆訊息錯誤，改用推播：%s", e)
+        smart_push_message(to, text)
 
 # === ✅ 處理訊息 ===
+CANCEL_KEYWORDS = ("不用處理", "繞過", "結束", "跳過", "沒關係")
+_CANCEL_RE = re.compile("|".join(map(re.escape, CANCEL_KEYWORDS)))
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     text = event.message.text.strip()
-    print("📩 收到訊息：", text)
+    to = get_push_target(event)
+    logger.info("📩 收到訊息：%s", text)
 
-    CANCEL_KEYWORDS = ["不用處理", "繞過", "結束", "跳過", "沒關係"]
-    if any(kw in text for kw in CANCEL_KEYWORDS):
-        smart_push_message(event, "✅ 已中斷處理")
+    if _CANCEL_RE.search(text):
+        smart_reply_message(event.reply_token, to, "✅ 已中斷處理")
         return
 
+    # GPT 分析與寫入交給背景 worker，webhook 立即回應 LINE；
+    # 結果由 worker 用同一個 reply token 一次回覆，不再先回「處理中」
+    reply_token = event.reply_token
+    backlog = work_queue.qsize()
     try:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⏳ 處理中..."))
-    except:
-        pass
+        if backlog >= MESSAGE_QUEUE_BUSY_THRESHOLD:
+            # 積壓中：reply token 先拿來告知延遲，之後的結果由 worker 推播
+            enqueue_message(None, to, text)
+            logger.warning("⚠️ 工作佇列積壓 %d 筆，延後回覆", backlog)
+            smart_reply_message(reply_token, to, "⏳ 忙碌中，稍後回覆")
+        else:
+            enqueue_message(reply_token, to, text)
+    except queue.Full:
+        # 佇列已滿或程序正在關閉
+        logger.warning("⚠️ 工作佇列已滿，略過訊息：%s", text)
+        smart_reply_message(reply_token, to, "⚠️ 系統忙碌中，請稍後再試")
 
+# === ✅ 背景處理（GPT 分析 + 寫入表單）===
+def process_message(reply_token, to, text):
     try:
-        record = analyze_message_with_gpt(text)
+        record = parse_message_fast(text)
+        from_gpt = record is None
+        if from_gpt:
+            record = analyze_message_with_gpt(text)
         if not record:
-            smart_push_message(event, "❌ 分析失敗，請再試一次")
+            smart_reply_message(reply_token, to, "❌ 分析失敗，請再試一次")
             return
 
         # 檢查缺欄位
@@ -165,19 +590,21 @@ def handle_message(event):
 
         if MISSING:
             msg = "❓ 請補充以下資料：\n" + "\n".join(f"- {m}" for m in MISSING)
-            smart_push_message(event, msg)
+            smart_reply_message(reply_token, to, msg)
             return
 
+        if from_gpt:
+            cache_gpt_record(text, record)
+        _item_categories[record["品項"]] = record["分類"]
         write_record_to_sheet(record)
         reply = f"✅ 已記錄：{record['品項']} × {record['數量']} = {record['單價'] * record['數量']} 元"
-        smart_push_message(event, reply)
+        smart_reply_message(reply_token, to, reply)
 
     except Exception as e:
-        print("❌ 發生錯誤：", e)
-        traceback.print_exc()
-        smart_push_message(event, "❌ 系統錯誤，請稍後再試")
+        logger.exception("❌ 發生錯誤：%s", e)
+        smart_reply_message(reply_token, to, "❌ 系統錯誤，請稍後再試")
 
-# === ✅ Flask 執行點（Render專用） ===
+# === ✅ Flask 執行點（本機開發用，Render 上由 gunicorn 啟動）===
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)